@@ -1,11 +1,16 @@
 # docker build . -t tg_bot_collect_checks-bot
 
 import math
+import time
 import traceback
+import logging
+import logging.handlers
+import queue
 import sys
 from telegram import (
     Update,
 )
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     ApplicationBuilder,
@@ -17,7 +22,7 @@ from telegram.ext import (
 )
 
 import database
-from send_telegram_message import send_telegram_message
+from send_telegram_message import send_telegram_message, close_session
 import config
 import google_sheets
 import asyncio
@@ -26,8 +31,51 @@ if sys.platform.startswith("win"):
     # switch from Proactor to Selector loop
     from asyncio import WindowsSelectorEventLoopPolicy
     asyncio.set_event_loop_policy(WindowsSelectorEventLoopPolicy())
+else:
+    # libuv-based loop: faster socket I/O for all Bot API, Sheets and DB calls
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
+logger = logging.getLogger(__name__)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route log records through a queue, so a slow stdout never blocks the event loop"""
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.WARNING)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    
+    # The listener thread does the actual (blocking) writes
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return listener
+
+
+# Number of single-use invite links minted ahead of time
+INVITE_POOL_SIZE = 10
+
+# Seconds to wait for queued alerts to be sent on shutdown
+ALERT_FLUSH_TIMEOUT = 10
+
+# The message templates never change at runtime - bind their format methods once
+format_start_text = config.start_text.format
+format_success_text = config.success_text.format
+format_alert_text = config.alert_text.format
+format_username_not_found_text = config.username_not_found_text.format
+
+# How much more the next person pays, in percent (constant for the whole run)
+NEXT_PAYMENT_INCREASE_PCT = round((config.GEOM_SEQ_R-1)*100, 2)
+
+
+# Errors are reported once per ERROR_REPORT_WINDOW seconds: fingerprint -> last report time,
+# in report order, holding at most ERROR_REPORT_MAXSIZE fingerprints
+ERROR_REPORT_WINDOW = 60
+ERROR_REPORT_MAXSIZE = 256
+MAX_ERROR_MESSAGE_LENGTH = 3500
+_reported_errors = {}
+
 
 # /start special entry function
 # THE WHOLE CODE IS BUILD WITH THE ASSUMPTION THAT THE USER WILL START FROM HERE
@@ -35,15 +83,11 @@ async def start_handle(update: Update, context: CallbackContext) -> None:
     chat_id = update.effective_chat.id
     username = update.effective_user.username or "NO_USERNAME"
     
-    # Ignore group
-    if chat_id < 0:
-        return
-    
     sum_to_pay, count, total_people, total_sum, paid = await context.application.bot_data["db"].get_user_data(chat_id=chat_id, username=username)
     
     # The user does not exist in the Google Sheets
     if paid is None:
-        await context.bot.send_message(chat_id=chat_id, text=config.username_not_found_text.format(username), parse_mode = "HTML")
+        await context.bot.send_message(chat_id=chat_id, text=format_username_not_found_text(username), parse_mode = "HTML")
         return
      
     # The user has already paid
@@ -51,7 +95,7 @@ async def start_handle(update: Update, context: CallbackContext) -> None:
         await context.bot.send_message(chat_id=chat_id, text=config.already_done_text, parse_mode = "HTML")
         return
     
-    await context.bot.send_message(chat_id=chat_id, text=config.start_text.format(count+1, total_people, sum_to_pay, sum_to_pay, math.ceil(total_sum/total_people), math.ceil(sum_to_pay*config.GEOM_SEQ_R), round((config.GEOM_SEQ_R-1)*100, 2)), parse_mode = "HTML")
+    await context.bot.send_message(chat_id=chat_id, text=format_start_text(count+1, total_people, sum_to_pay, sum_to_pay, math.ceil(total_sum/total_people), math.ceil(sum_to_pay*config.GEOM_SEQ_R), NEXT_PAYMENT_INCREASE_PCT), parse_mode = "HTML")
 
 
 async def post_init(application: Application) -> None:
@@ -62,76 +106,209 @@ async def post_init(application: Application) -> None:
     db = await database.AsyncDatabase.create()
     application.bot_data["db"] = db
 
+    # Pre-mint invite links in the background so they are off the check upload path
+    application.bot_data["invite_pool"] = asyncio.Queue(maxsize=INVITE_POOL_SIZE)
+    application.bot_data["invite_refiller"] = asyncio.create_task(invite_refiller(application))
+
+    # One alert queue and worker per alert chat, so alerts never hold up user replies
+    application.bot_data["alert_queues"] = {alert_chat_id: asyncio.Queue() for alert_chat_id in config.telegram_alerts_chats}
+    application.bot_data["alert_workers"] = [
+        asyncio.create_task(alert_worker(application, alert_chat_id, alert_queue))
+        for alert_chat_id, alert_queue in application.bot_data["alert_queues"].items()
+    ]
+
+
+async def post_stop(application: Application) -> None:
+    # Stop minting invite links while the bot can still revoke them
+    refiller = application.bot_data["invite_refiller"]
+    refiller.cancel()
+    await asyncio.gather(refiller, return_exceptions=True)
+    
+    # Revoke the unused pooled links, so they don't pile up in the group's invite link list
+    invite_pool = application.bot_data["invite_pool"]
+    unused_links = []
+    while not invite_pool.empty():
+        unused_links.append(invite_pool.get_nowait())
+    await asyncio.gather(*(revoke_invite_link(application, invite_link) for invite_link in unused_links))
+    
+    # Deliver the queued alerts while the bot can still send messages
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(alert_queue.join() for alert_queue in application.bot_data["alert_queues"].values())),
+            timeout=ALERT_FLUSH_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Not all alerts were sent before the shutdown")
+    
+    for worker in application.bot_data["alert_workers"]:
+        worker.cancel()
+
+
+async def post_shutdown(application: Application) -> None:
+    # Stop the Google Sheets sync and close the connection pool explicitly
+    await application.bot_data["db"].close()
+    
+    # Close the error reporting session after the last error could have been reported
+    await close_session()
+
+
+async def alert_worker(application: Application, alert_chat_id: str, alert_queue: asyncio.Queue) -> None:
+    """Send queued (photo, caption) check alerts to one alert chat in order"""
+    while True:
+        photo, caption = await alert_queue.get()
+        try:
+            # AIORateLimiter waits out RetryAfter (flood control) errors and retries
+            await application.bot.send_photo(chat_id=alert_chat_id, photo=photo, caption=caption, parse_mode="HTML")
+        except Exception as e:
+            logger.error(f"Error sending an alert to {alert_chat_id}: {e}")
+        finally:
+            alert_queue.task_done()
+
+
+async def invite_refiller(application: Application) -> None:
+    """Keep the invite pool filled with single-use invite links"""
+    invite_pool = application.bot_data["invite_pool"]
+    
+    while True:
+        try:
+            invite_link = await application.bot.create_chat_invite_link(chat_id=config.group_chat_id, member_limit=1)
+            try:
+                # Blocks while the pool is full
+                await invite_pool.put(invite_link.invite_link)
+            except asyncio.CancelledError:
+                # Stopped while waiting for room - this link never reaches the pool
+                await revoke_invite_link(application, invite_link.invite_link)
+                raise
+        except Exception as e:
+            logger.error(f"Error refilling the invite pool: {e}")
+            await asyncio.sleep(5)
+
+
+async def revoke_invite_link(application: Application, invite_link: str) -> None:
+    """Revoke an invite link that was minted but never handed out"""
+    try:
+        await application.bot.revoke_chat_invite_link(chat_id=config.group_chat_id, invite_link=invite_link)
+    except Exception as e:
+        logger.error(f"Error revoking an unused invite link: {e}")
+
+
+async def return_invite_link(application: Application, invite_link: str) -> None:
+    """Put an invite link that was not handed out back into the pool, revoke it if the pool is full"""
+    try:
+        application.bot_data["invite_pool"].put_nowait(invite_link)
+    except asyncio.QueueFull:
+        await revoke_invite_link(application, invite_link)
+
+
+async def get_invite_link(context: CallbackContext) -> str:
+    """Take a pre-minted invite link from the pool, create one directly if the pool is empty"""
+    try:
+        return context.application.bot_data["invite_pool"].get_nowait()
+    except asyncio.QueueEmpty:
+        invite_link = await context.bot.create_chat_invite_link(chat_id=config.group_chat_id, member_limit=1)
+        return invite_link.invite_link
+
 
 async def message_handle(update: Update, context: CallbackContext) -> None:
+    # Only new photos from private chats get here (see the MessageHandler filters)
     chat_id = update.effective_chat.id
-
-    # Сheck if message is edited (to avoid AttributeError: 'NoneType' object has no attribute 'from_user')
-    # or if the message is from a group (chat_id < 0)
-    if update.edited_message or (not update.message) or chat_id < 0:
-        return
+    username = update.effective_user.username or "NO_USERNAME"
     
-    if update.message.photo:
-        file_id = update.message.photo[-1].file_id
-        file = await context.bot.get_file(file_id)
-        file_url = file.file_path
-        
-        username = update.effective_user.username or "NO_USERNAME"
-        sum_to_pay, count, total_people, total_sum, paid = await context.application.bot_data["db"].get_user_data(chat_id=chat_id, username=username)
-
-        if not paid is None:
-            if paid == False:
-                unique_invite_link = await context.bot.create_chat_invite_link(chat_id=config.group_chat_id, 
-                                                                                member_limit=1)
-                unique_invite_link = unique_invite_link.invite_link
-                
+    # The last photo size is the largest one
+    photo = update.message.photo[-1]
+    file_id = photo.file_id
+    
+    # The file_id is all Telegram needs to resend the photo, so the file URL is never resolved
+    sum_to_pay, count, total_people, total_sum, paid = await context.application.bot_data["db"].get_user_data(chat_id=chat_id, username=username)
+
+    if not paid is None:
+        if paid == False:
+            # Get the invite link first: if that fails nothing is recorded and the user can resend the check
+            unique_invite_link = await get_invite_link(context)
+            try:
                 count, sum_to_pay, elapsed_interval = await context.application.bot_data["db"].insert_check_link(
                     chat_id=chat_id,
                     username=username,
-                    check_link=file_url,
                     check_file_id=file_id,
                 )
-                                
-                row_number = await google_sheets.color_and_insert_data(username, count, sum_to_pay, elapsed_interval)
-                                
-                for alert_chat_id in config.telegram_alerts_chats:
-                    await context.bot.send_photo(
-                        chat_id=alert_chat_id,
-                        photo=file_id,
-                        caption=config.alert_text.format(count+1, username, sum_to_pay),
-                        parse_mode="HTML"
-                    )
-                
-                await context.bot.send_message(chat_id=chat_id, text=config.success_text.format(unique_invite_link, row_number), parse_mode = "HTML")
-            else: # already paid (green in the table)
-                await context.bot.send_message(chat_id=chat_id, text=config.already_done_text, parse_mode = "HTML")
-        else: # no such row in the table
-            await context.bot.send_message(chat_id=chat_id, text=config.username_not_found_text.format(username), parse_mode = "HTML")
-    else: # no photo in the message
-        await context.bot.send_message(chat_id=chat_id, text=config.wrong_message_text, parse_mode = "HTML")
-    
+            except Exception:
+                # The link was never handed out - keep it for the next check
+                await return_invite_link(context.application, unique_invite_link)
+                raise
+            
+            if count is None:
+                await return_invite_link(context.application, unique_invite_link)
+                raise ValueError(f"No checks row for chat {chat_id} (@{username}) to record the check in")
+
+            row_number = await google_sheets.get_row_number(username)
+            
+            # Spreadsheet bookkeeping is not needed for the reply - do it in the background,
+            # passing the update so that a failure is reported through error_handle
+            context.application.create_task(
+                google_sheets.color_and_insert_data(username, count, sum_to_pay, elapsed_interval),
+                update=update,
+            )
+            
+            # Alerts are sent by the alert workers, the user doesn't wait for them
+            alert_caption = format_alert_text(count+1, username, sum_to_pay)
+            for alert_queue in context.application.bot_data["alert_queues"].values():
+                alert_queue.put_nowait((file_id, alert_caption))
+            
+            await context.bot.send_message(chat_id=chat_id, text=format_success_text(unique_invite_link, row_number), parse_mode = "HTML")
+        else: # already paid (green in the table)
+            await context.bot.send_message(chat_id=chat_id, text=config.already_done_text, parse_mode = "HTML")
+    else: # no such row in the table
+        await context.bot.send_message(chat_id=chat_id, text=format_username_not_found_text(username), parse_mode = "HTML")
+
+
+async def wrong_message_handle(update: Update, context: CallbackContext) -> None:
+    # Anything but a photo (or /start) in a private chat
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=config.wrong_message_text, parse_mode = "HTML")
+
 
 async def error_handle(update: Update, context: CallbackContext) -> None:
-    exc_info = sys.exc_info()
+    error = context.error
 
-    if exc_info[0] is None:
-        error_message = "ERROR\nbot.py:\nAn error occurred, but no exception was raised."
+    if error is None:
+        fingerprint = None
     else:
-        tb_list = traceback.format_exception(*exc_info)
-        tb_string = ''.join(tb_list)
-        
-        error_message = f"ERROR\nbot.py:\n{tb_string}"
+        # Identify the error by its type and the line it was raised at
+        tb = error.__traceback__
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+        fingerprint = (type(error).__name__, tb.tb_frame.f_code.co_filename, tb.tb_lineno) if tb else (type(error).__name__,)
     
-    try:
-        await send_telegram_message(error_message)
-        print(error_message)
-    except: pass
+    # Report each distinct error at most once per window, so error storms don't eat the message budget
+    now = time.time()
+    if now - _reported_errors.get(fingerprint, 0) >= ERROR_REPORT_WINDOW:
+        # Re-insert at the end and drop the fingerprints whose window is over (or the oldest ones)
+        _reported_errors.pop(fingerprint, None)
+        while _reported_errors:
+            oldest_fingerprint, reported_at = next(iter(_reported_errors.items()))
+            if now - reported_at < ERROR_REPORT_WINDOW and len(_reported_errors) < ERROR_REPORT_MAXSIZE:
+                break
+            del _reported_errors[oldest_fingerprint]
+        _reported_errors[fingerprint] = now
+        
+        if error is None:
+            error_message = "ERROR\nbot.py:\nAn error occurred, but no exception was raised."
+        else:
+            # Keep the innermost frames and stay below the Telegram message length limit
+            tb_string = ''.join(traceback.format_exception(type(error), error, error.__traceback__, limit=-10))
+            error_message = f"ERROR\nbot.py:\n{tb_string[-MAX_ERROR_MESSAGE_LENGTH:]}"
+        
+        logger.error(error_message)
+        try:
+            await send_telegram_message(error_message)
+        except: pass
     
-    await start_handle(update, context)
-
+    # Re-prompt the user only when talking to Telegram failed, DB or Sheets errors would just repeat
+    if isinstance(error, TelegramError) and isinstance(update, Update) and update.effective_chat:
+        await start_handle(update, context)
 
 
 if __name__ == "__main__":
+    log_listener = setup_logging()
     print("Starting...")
     
     application = (
@@ -141,13 +318,26 @@ if __name__ == "__main__":
         .rate_limiter(AIORateLimiter(max_retries=5))
         .http_version("1.1")
         .get_updates_http_version("1.1")
+        # Keep enough keep-alive connections to api.telegram.org for concurrent updates,
+        # so Bot API calls reuse warm connections instead of paying TCP+TLS setup
+        .connection_pool_size(256)
+        .pool_timeout(5.0)
+        .connect_timeout(5.0)
+        .read_timeout(20.0)
         .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
-    application.add_handler(CommandHandler("start", start_handle))
-    application.add_handler(MessageHandler(filters.ALL, message_handle))
+    application.add_handler(CommandHandler("start", start_handle, filters=filters.ChatType.PRIVATE))
+    application.add_handler(MessageHandler(filters.PHOTO & ~filters.UpdateType.EDITED & filters.ChatType.PRIVATE, message_handle))
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.PHOTO & ~filters.UpdateType.EDITED, wrong_message_handle))
     application.add_error_handler(error_handle)
 
 
-    application.run_polling()
\ No newline at end of file
+    # Long-poll getUpdates for up to 50 seconds and ask again immediately after a response.
+    # All handlers work on new messages only, so don't let Telegram send any other update type
+    application.run_polling(timeout=50, poll_interval=0.0, allowed_updates=[Update.MESSAGE])
+    
+    log_listener.stop()
\ No newline at end of file
@@ -1,43 +1,67 @@
 import asyncio
+import random
+from collections import namedtuple
 from typing import Optional, Tuple
-import psycopg
+from psycopg_pool import AsyncConnectionPool
 import config
 import google_sheets
 import time
+from datetime import timedelta
+
+
+# At most this many get_user_data results are kept
+USER_CACHE_MAXSIZE = 10_000
+
+# Cached google_sheet_data row, with sets for O(1) username lookups
+SheetCache = namedtuple("SheetCache", "total_people total_sum column_A_list paid_usernames column_A_set paid_set geom_seq_a")
 
 
 class AsyncDatabase:    
-    def __init__(self, pg_conn):
-        self.pg_conn = pg_conn
+    def __init__(self, pool: AsyncConnectionPool):
+        self.pool = pool
         self._background_task: Optional[asyncio.Task] = None
         self._stop_event = asyncio.Event()
+        # Consecutive failed sync cycles, drives the backoff
+        self._error_count = 0
         # Optimized cache with timestamp
         self._sheet_cache = None
         self._cache_timestamp = 0
         self._cache_ttl = config.TTL
+        # Per-user cache of get_user_data results: (chat_id, username) -> (result, timestamp),
+        # kept in write order so the oldest entries are at the front
+        self._user_cache = {}
+        # (chat_id, username) -> [lock, number of lookups holding or waiting for it]
+        self._user_locks = {}
     
     @classmethod
     async def create(cls):
-        """Create database instance with connection and setup"""
-        pg_conn = await psycopg.AsyncConnection.connect(
-            host=config.pg_conf_keys["host"],
-            dbname=config.pg_conf_keys["dbname"],
-            user=config.pg_conf_keys["user"],
-            password=config.pg_conf_keys["password"],
-            port=config.pg_conf_keys["port"],
-            prepare_threshold=5,
+        """Create database instance with connection pool and setup"""
+        # A pool lets concurrent handlers run their queries in parallel instead of queueing on one connection
+        pool = AsyncConnectionPool(
+            kwargs={
+                "host": config.pg_conf_keys["host"],
+                "dbname": config.pg_conf_keys["dbname"],
+                "user": config.pg_conf_keys["user"],
+                "password": config.pg_conf_keys["password"],
+                "port": config.pg_conf_keys["port"],
+                # The bot runs a small fixed set of queries - prepare them from their second execution
+                "prepare_threshold": 1,
+                "autocommit": True,
+            },
+            min_size=2,
+            max_size=10,
+            open=False,
         )
+        await pool.open(wait=True)
         
-        db = cls(pg_conn)
+        db = cls(pool)
         await db._setup()
         db.start_googlesheets_sync()
         return db
     
     async def _setup(self):
         """Initialize database tables with optimized schema"""
-        await self.pg_conn.set_autocommit(True)
-        
-        async with self.pg_conn.cursor() as cursor:
+        async with self.pool.connection() as conn, conn.cursor() as cursor:
             # Create tables and indexes in a single batch
             await cursor.execute("""
                 -- Create tables
@@ -63,9 +87,17 @@ class AsyncDatabase:
                     CONSTRAINT single_row CHECK (id = 1)
                 );
                 
+                -- Hands out the counts (the position in the payment queue) of new checks
+                CREATE SEQUENCE IF NOT EXISTS checks_count_seq MINVALUE 0 START WITH 0;
+                -- Continue after the counts already stored
+                SELECT setval('checks_count_seq', MAX(count)) FROM checks HAVING MAX(count) IS NOT NULL;
+                
                 -- Create indexes
                 CREATE INDEX IF NOT EXISTS idx_checks_username ON checks(username);
-                CREATE INDEX IF NOT EXISTS idx_checks_chat_id ON checks(chat_id);
+                -- chat_id is the primary key already, this index also carries the columns
+                -- get_user_data reads, so its lookup is an index-only scan
+                DROP INDEX IF EXISTS idx_checks_chat_id;
+                CREATE INDEX IF NOT EXISTS idx_checks_chat_id_cov ON checks(chat_id) INCLUDE (count, sum_to_pay);
                 
                 -- Initialize with default data
                 INSERT INTO google_sheet_data (total_people, total_sum, people_usernames)
@@ -113,16 +145,25 @@ class AsyncDatabase:
                 try:
                     google_sheet_data = await google_sheets.fetch_list()
                     
-                    if google_sheet_data and self._is_valid_sheet_data(google_sheet_data):
-                        current_hash = hash(str(google_sheet_data))
-                        
-                        if prev_data_hash != current_hash:
-                            await self._update_sheet_data(google_sheet_data)
-                            prev_data_hash = current_hash
-                            # Update cache with current time
-                            self._sheet_cache = google_sheet_data
-                            self._cache_timestamp = time.time()
-                            print("Google Sheets data updated")
+                    # fetch_list returns None when the Sheets request fails - back off like on any other error
+                    if not (google_sheet_data and self._is_valid_sheet_data(google_sheet_data)):
+                        raise ValueError("Failed to fetch valid Google Sheets data")
+                    
+                    # Hash the fields directly instead of building a string of the whole dict
+                    current_hash = hash((
+                        google_sheet_data["total_people"],
+                        google_sheet_data["total_sum"],
+                        tuple(google_sheet_data["column_A_list"]),
+                    ))
+                    
+                    if prev_data_hash != current_hash:
+                        row = await self._update_sheet_data(google_sheet_data)
+                        prev_data_hash = current_hash
+                        # Update cache with the stored row (it also has paid_usernames)
+                        self._set_sheet_cache(row)
+                        print("Google Sheets data updated")
+                    
+                    self._error_count = 0
                     
                     # Efficient sleep with cancellation
                     try:
@@ -136,7 +177,10 @@ class AsyncDatabase:
                         
                 except Exception as e:
                     print(f"Error in Google Sheets sync: {e}")
-                    await asyncio.sleep(min(60, 5 * 2**min(3, getattr(self, '_error_count', 0))))
+                    # Exponential backoff capped at 60s, then jittered so retries don't run in lockstep
+                    self._error_count += 1
+                    delay = min(60, 5 * 2**min(6, self._error_count)) * random.uniform(0.5, 1.5)
+                    await asyncio.sleep(delay)
                     
         finally:
             print("Google Sheets sync cleanup completed")
@@ -150,9 +194,9 @@ class AsyncDatabase:
             isinstance(data.get("total_sum"), int)
         )
     
-    async def _update_sheet_data(self, data: dict):
-        """Update Google Sheets data - single atomic operation"""
-        async with self.pg_conn.cursor() as cur:
+    async def _update_sheet_data(self, data: dict) -> tuple:
+        """Update Google Sheets data - single atomic operation, returns the updated row"""
+        async with self.pool.connection() as conn, conn.cursor(binary=True) as cur:
             await cur.execute(
                 """
                 UPDATE google_sheet_data 
@@ -161,9 +205,29 @@ class AsyncDatabase:
                     people_usernames = %s,
                     updated_at = NOW()
                 WHERE id = 1
+                RETURNING total_people, total_sum, people_usernames, paid_usernames
                 """,
                 (data["total_people"], data["total_sum"], data["column_A_list"])
             )
+            return await cur.fetchone()
+    
+    def _set_sheet_cache(self, row: tuple) -> SheetCache:
+        """Cache a google_sheet_data row as a SheetCache"""
+        total_people, total_sum, column_A_list, paid_usernames = row
+        r = config.GEOM_SEQ_R
+        sheet_data = SheetCache(
+            total_people=total_people,
+            total_sum=total_sum,
+            column_A_list=column_A_list,
+            paid_usernames=paid_usernames,
+            column_A_set=frozenset(column_A_list),
+            paid_set=frozenset(paid_usernames),
+            # First term of the geometric series of payments, None means everyone pays equally
+            geom_seq_a=total_sum * (1 - r) / (1 - r ** total_people) if total_people > 0 and r != 1 else None,
+        )
+        self._sheet_cache = sheet_data
+        self._cache_timestamp = time.time()
+        return sheet_data
     
     async def _get_cached_sheet_data(self):
         """Get sheet data from cache or database"""
@@ -174,122 +238,161 @@ class AsyncDatabase:
             current_time - self._cache_timestamp < self._cache_ttl):
             return self._sheet_cache
         
-        # Fetch from database
-        async with self.pg_conn.cursor() as cursor:
+        # Fetch from database (like all hot-path queries, with a binary cursor:
+        # ints, arrays and intervals are sent as is instead of being formatted and parsed as text)
+        async with self.pool.connection() as conn, conn.cursor(binary=True) as cursor:
             await cursor.execute(
-                "SELECT total_people, total_sum, people_usernames, paid_usernames FROM google_sheet_data WHERE id = 1"
+                "SELECT total_people, total_sum, people_usernames, paid_usernames FROM google_sheet_data WHERE id = 1",
+                prepare=True,
             )
             row = await cursor.fetchone()
             
             if row:
-                sheet_data = {
-                    "total_people": row[0],
-                    "total_sum": row[1],
-                    "column_A_list": row[2],
-                    "paid_usernames": row[3]
-                }
-                # Update cache
-                self._sheet_cache = sheet_data
-                self._cache_timestamp = current_time
-                return sheet_data
+                return self._set_sheet_cache(row)
         
         return None
     
     async def get_user_data(self, chat_id: int, username: str) -> Tuple[int, int, int, int, Optional[bool]]:
         """
         Get user values and payment status - heavily optimized.
+        Results are cached per user for TTL seconds and invalidated by insert_check_link.
         
         Returns:
             Tuple[int, int, int, int, Optional[bool]]: 
             (sum_to_pay, count, total_people, total_sum, paid)
         """
+        key = (chat_id, username)
+        
+        # Serialize lookups of the same user so concurrent updates reuse one result
+        lock_entry = self._user_locks.get(key)
+        if lock_entry is None:
+            lock_entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        lock_entry[1] += 1
+        try:
+            async with lock_entry[0]:
+                cached = self._user_cache.get(key)
+                if cached and time.time() - cached[1] < self._cache_ttl:
+                    return cached[0]
+                
+                result = await self._fetch_user_data(chat_id, username)
+                self._cache_user_data(key, result)
+                return result
+        finally:
+            # Drop the lock once no other lookup of this user holds or waits for it
+            lock_entry[1] -= 1
+            if lock_entry[1] == 0:
+                del self._user_locks[key]
+    
+    def _cache_user_data(self, key: tuple, result: tuple):
+        """Cache a get_user_data result, evicting expired entries and keeping at most USER_CACHE_MAXSIZE"""
+        now = time.time()
+        # Re-insert at the end, so the cache stays in write order
+        self._user_cache.pop(key, None)
+        
+        while self._user_cache:
+            oldest_key, (_, timestamp) = next(iter(self._user_cache.items()))
+            if now - timestamp < self._cache_ttl and len(self._user_cache) < USER_CACHE_MAXSIZE:
+                break
+            del self._user_cache[oldest_key]
+        
+        self._user_cache[key] = (result, now)
+    
+    async def _fetch_user_data(self, chat_id: int, username: str) -> Tuple[int, int, int, int, Optional[bool]]:
+        """Get user values and payment status from the sheet data and checks table"""
         sheet_data = await self._get_cached_sheet_data()
         if not sheet_data:
             raise ValueError("Unable to fetch sheet data")
         
-        total_people = sheet_data["total_people"]
-        total_sum = sheet_data["total_sum"]
-        paid_usernames = sheet_data.get("paid_usernames", [])
-        paid = username in paid_usernames if username in sheet_data["column_A_list"] else None
+        total_people = sheet_data.total_people
+        total_sum = sheet_data.total_sum
+        paid = username in sheet_data.paid_set if username in sheet_data.column_A_set else None
         
         # User is not in the column_A_list
         if paid is None:
             return None, None, None, None, None
         
-        async with self.pg_conn.cursor() as cursor:
-            await cursor.execute(
-                "SELECT count, sum_to_pay, total_people FROM checks WHERE chat_id = %s",
-                (chat_id,)
-            )
-            
-            existing = await cursor.fetchone()
-            
-            if existing:
-                return existing[1], existing[0], total_people, total_sum, paid
-            
-            # User doesn't exist, create new entry
-            await cursor.execute("SELECT COALESCE(MAX(count), -1) + 1 FROM checks")
-            count = (await cursor.fetchone())[0]
-            
-            # Calculate sum_to_pay
-            if total_people > 0 and config.GEOM_SEQ_R != 1:
-                geom_seq_a = total_sum * (1 - config.GEOM_SEQ_R) / (1 - config.GEOM_SEQ_R ** total_people)
-                sum_to_pay = int(geom_seq_a * (config.GEOM_SEQ_R ** count) + 0.5)  # Round to nearest int
-            else:
-                sum_to_pay = total_sum // max(total_people, 1)
-            
-            # Insert new user
+        # Read the existing entry or create it, in a single round-trip:
+        # the next count (from checks_count_seq) and the geometric series term (from the cached first term) are computed by Postgres
+        async with self.pool.connection() as conn, conn.cursor(binary=True) as cursor:
             await cursor.execute(
                 """
-                INSERT INTO checks (chat_id, username, count, total_people, sum_to_pay)
-                VALUES (%s, %s, %s, %s, %s)
+                WITH existing AS (
+                    SELECT count, sum_to_pay FROM checks WHERE chat_id = %(chat_id)s
+                ),
+                next AS (
+                    -- Only new users take a count, concurrent ones always get different counts
+                    SELECT nextval('checks_count_seq')::INT AS count
+                    WHERE NOT EXISTS (SELECT 1 FROM existing)
+                ),
+                inserted AS (
+                    INSERT INTO checks (chat_id, username, count, total_people, sum_to_pay)
+                    SELECT %(chat_id)s, %(username)s, next.count, %(total_people)s,
+                        CASE WHEN %(geom_seq_a)s::float8 IS NOT NULL THEN
+                            -- Round to nearest int
+                            FLOOR(%(geom_seq_a)s::float8 * POWER(%(r)s, next.count) + 0.5)
+                        ELSE
+                            %(total_sum)s / GREATEST(%(total_people)s, 1)
+                        END
+                    FROM next
+                    RETURNING count, sum_to_pay
+                )
+                SELECT count, sum_to_pay FROM existing
+                UNION ALL
+                SELECT count, sum_to_pay FROM inserted
                 """,
-                (chat_id, username, count, total_people, sum_to_pay)
+                {
+                    "chat_id": chat_id,
+                    "username": username,
+                    "total_people": total_people,
+                    "total_sum": total_sum,
+                    "geom_seq_a": sheet_data.geom_seq_a,
+                    "r": config.GEOM_SEQ_R,
+                },
+                prepare=True,
             )
             
+            count, sum_to_pay = await cursor.fetchone()
             return sum_to_pay, count, total_people, total_sum, paid
     
-    async def insert_check_link(self, chat_id: int, username: str, check_link: str, check_file_id: str) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    async def insert_check_link(self, chat_id: int, username: str, check_file_id: str) -> Tuple[Optional[int], Optional[int], Optional[timedelta]]:
         """Insert check link and return user data - optimized with single transaction"""
-        async with self.pg_conn.cursor() as cursor:
+        async with self.pool.connection() as conn, conn.cursor(binary=True) as cursor:
             # Single transaction combining both operations
             await cursor.execute(
                 """
                 WITH updated_payment AS (
+                    -- Rows of users who are in the list already are not touched (and not rewritten)
                     UPDATE google_sheet_data
-                    SET paid_usernames = CASE 
-                        WHEN NOT (%s = ANY(paid_usernames)) THEN
-                            array_append(paid_usernames, %s)
-                        ELSE paid_usernames
-                    END
-                    WHERE id = 1
+                    SET paid_usernames = paid_usernames || ARRAY[%s]
+                    WHERE id = 1 AND NOT (%s = ANY(paid_usernames))
                     RETURNING 1
                 ),
                 updated_check AS (
                     UPDATE checks
-                    SET check_link = %s, check_file_id = %s, check_received_at = NOW()
+                    SET check_file_id = %s, check_received_at = NOW()
                     WHERE chat_id = %s
-                    RETURNING count, sum_to_pay, EXTRACT(EPOCH FROM (NOW() - first_seen_at))
+                    RETURNING count, sum_to_pay, NOW() - first_seen_at AS elapsed
                 )
-                SELECT count, sum_to_pay, MAKE_INTERVAL(secs => EXTRACT(EPOCH FROM INTERVAL '1 second' * elapsed))
-                FROM updated_check uc, (SELECT EXTRACT(EPOCH FROM (NOW() - first_seen_at)) as elapsed FROM checks WHERE chat_id = %s) e;
+                SELECT count, sum_to_pay, elapsed FROM updated_check;
                 """,
-                (username, username, check_link, check_file_id, chat_id, chat_id)
+                (username, username, check_file_id, chat_id),
+                prepare=True,
             )
             
             result = await cursor.fetchone()
             if result is None:
                 return None, None, None
             
-            # Invalidate cache since paid_usernames changed
+            # Invalidate caches since paid_usernames changed
             self._cache_timestamp = 0
+            self._user_cache.pop((chat_id, username), None)
             
-            return result[0], result[1], str(result[2])
+            return result
         
     async def close(self):
         """Close database connection and stop background tasks"""
         await self.stop_background_sync()
-        await self.pg_conn.close()
+        await self.pool.close()
     
     def is_sync_running(self) -> bool:
         """Check if background sync is running"""
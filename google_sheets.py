@@ -1,32 +1,79 @@
 import asyncio
+import threading
 from google.oauth2.service_account import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+from googleapiclient.model import JsonModel
+import orjson
 import config
 from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import functools
 
-# Reduced thread pool size for better resource management
-_executor = ThreadPoolExecutor(max_workers=10, thread_name_prefix="sheets-api")
+# Dedicated thread for the blocking Sheets calls, so they never queue behind other
+# run_in_executor users. A single thread is enough: only a few calls are ever in flight
+# (the periodic sync and check uploads), they are quota-limited anyway, and the shared
+# httplib2 connection of the service must not be used by two threads at once
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets-api")
 
 # Cache the service instance - no need for LRU cache with maxsize=32 for a single service
 _sheets_service = None
+# Guards the first creation so concurrent first calls build the service only once
+_sheets_service_lock = asyncio.Lock()
+# Same for the executor threads, in case the service is ever built from more than one event loop
+_sheets_service_thread_lock = threading.Lock()
+
+# Row numbers of column A usernames, refreshed by every fetch_list batch request
+_row_numbers: dict[str, int] = {}
+
+# The column A read in flight for unknown usernames, if any
+_row_numbers_refresh: asyncio.Task | None = None
+
+# Deletes "@" in a single C-level pass over the username
+_AT_TABLE = str.maketrans("", "", "@")
+
+# sheetId of config.google_sheet_name, looked up on first use (it never changes)
+_sheet_id: int | None = None
+
+class _OrjsonModel(JsonModel):
+    """JsonModel that parses the responses with orjson instead of the json module."""
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and isinstance(body, dict) and "data" in body:
+            body = body["data"]
+        return body
 
 def _create_sheets_service():
     """Create Google Sheets API service object once."""
     global _sheets_service
-    if _sheets_service is None:
-        creds = Credentials.from_service_account_file(
-            "google_sheets_key.json", 
-            scopes=["https://www.googleapis.com/auth/spreadsheets"]
-        )
-        _sheets_service = build("sheets", "v4", credentials=creds)
+    with _sheets_service_thread_lock:
+        if _sheets_service is None:
+            creds = Credentials.from_service_account_file(
+                "google_sheets_key.json", 
+                scopes=["https://www.googleapis.com/auth/spreadsheets"]
+            )
+            # Same transport build() would create, with a 30s instead of a 120s timeout,
+            # so a stalled Sheets call gives up sooner
+            http = build_http()
+            http.timeout = 30
+            authed_http = AuthorizedHttp(creds, http=http)
+            # The discovery document ships with googleapiclient, skip probing the file cache
+            _sheets_service = build("sheets", "v4", http=authed_http, cache_discovery=False, model=_OrjsonModel())
     return _sheets_service
 
 async def get_sheets_service():
     """Get the cached Google Sheets API service."""
-    if _sheets_service is None:
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(_executor, _create_sheets_service)
+    if _sheets_service is not None:
+        return _sheets_service
+    
+    async with _sheets_service_lock:
+        if _sheets_service is None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(_executor, _create_sheets_service)
     return _sheets_service
 
 async def _execute_request(request):
@@ -34,6 +81,12 @@ async def _execute_request(request):
     loop = asyncio.get_running_loop()
     return await loop.run_in_executor(_executor, request.execute)
 
+def _to_int(value) -> int:
+    """Convert an unformatted cell value to int, a number typed in as text keeps its separators."""
+    if isinstance(value, str):
+        return int(value.replace(",", "").replace(".", ""))
+    return int(value)
+
 async def fetch_list() -> dict | None:
     """Fetch data from specified ranges in a single batch request."""
     try:
@@ -46,26 +99,35 @@ async def fetch_list() -> dict | None:
                 f"{config.google_sheet_name}!A2:A",
                 f"{config.google_sheet_name}!F2",
                 f"{config.google_sheet_name}!G2"
-            ]
+            ],
+            # Column A comes back as one flat list, and only the values are sent
+            majorDimension="COLUMNS",
+            # Numbers come back as JSON numbers, without the sheet's thousands separators
+            valueRenderOption="UNFORMATTED_VALUE",
+            fields="valueRanges(values)"
         )
         
         response = await _execute_request(batch_request)
         value_ranges = response.get('valueRanges', [])
         
-        # Process column A data
+        # Process column A data (the range starts at row 2)
         column_A_data = []
+        row_numbers = {}
         if value_ranges and 'values' in value_ranges[0]:
-            column_A_data = [
-                str(row[0]).replace("@", "").strip() 
-                for row in value_ranges[0]['values'] 
-                if row and row[0]
-            ]
+            for idx, cell in enumerate(value_ranges[0]['values'][0], start=2):
+                if cell:
+                    cell_value = str(cell).translate(_AT_TABLE).strip()
+                    column_A_data.append(cell_value)
+                    row_numbers.setdefault(cell_value, idx)
+        
+        global _row_numbers
+        _row_numbers = row_numbers
         
         # Process F2 value (total_people)
         total_people = None
         if len(value_ranges) > 1 and 'values' in value_ranges[1] and value_ranges[1]['values']:
             try:
-                total_people = int(value_ranges[1]['values'][0][0].replace(",", "").replace(".", ""))
+                total_people = _to_int(value_ranges[1]['values'][0][0])
             except (ValueError, IndexError):
                 pass
         
@@ -73,7 +135,7 @@ async def fetch_list() -> dict | None:
         total_sum = None
         if len(value_ranges) > 2 and 'values' in value_ranges[2] and value_ranges[2]['values']:
             try:
-                total_sum = int(value_ranges[2]['values'][0][0].replace(",", "").replace(".", ""))
+                total_sum = _to_int(value_ranges[2]['values'][0][0])
             except (ValueError, IndexError):
                 pass
         
@@ -86,97 +148,190 @@ async def fetch_list() -> dict | None:
     except Exception:
         return None
 
+async def _fetch_row_numbers(sheets_api) -> dict[str, int]:
+    """Read the whole column A and index the row number of every username."""
+    values_request = sheets_api.spreadsheets().values().get(
+        spreadsheetId=config.google_sheet_id, 
+        range=f"{config.google_sheet_name}!A:A",
+        majorDimension="COLUMNS",
+        fields="values"
+    )
+    
+    response = await _execute_request(values_request)
+    column = response["values"][0] if response.get("values") else []
+    
+    row_numbers = {}
+    for idx, cell in enumerate(column, start=1):
+        if cell:  # Check if cell is not empty
+            row_numbers.setdefault(str(cell).translate(_AT_TABLE).strip(), idx)
+    
+    return row_numbers
+
+async def get_sheet_id(sheets_api) -> int:
+    """Get the sheetId of config.google_sheet_name, fetching the spreadsheet metadata only once."""
+    global _sheet_id
+    if _sheet_id is not None:
+        return _sheet_id
+    
+    # Only the sheet properties are needed, not the whole spreadsheet resource
+    metadata_request = sheets_api.spreadsheets().get(
+        spreadsheetId=config.google_sheet_id,
+        fields="sheets.properties(sheetId,title)"
+    )
+    response = await _execute_request(metadata_request)
+    
+    for sheet in response.get("sheets", []):
+        if sheet["properties"]["title"] == config.google_sheet_name:
+            _sheet_id = sheet["properties"]["sheetId"]
+            return _sheet_id
+    
+    raise ValueError(f"Sheet {config.google_sheet_name} not found in the Google Sheet")
+
+async def _refresh_row_numbers() -> dict[str, int]:
+    """Read column A and replace the row number index with the result."""
+    global _row_numbers
+    sheets_api = await get_sheets_service()
+    row_numbers = await _fetch_row_numbers(sheets_api)
+    
+    # The column was read anyway - keep the whole index until the next fetch_list, so the
+    # background color_and_insert_data and other new usernames don't read column A again
+    _row_numbers = row_numbers
+    return row_numbers
+
+def _clear_row_numbers_refresh(task: asyncio.Task):
+    global _row_numbers_refresh
+    if _row_numbers_refresh is task:
+        _row_numbers_refresh = None
+
+async def _shared_refresh_row_numbers() -> dict[str, int]:
+    """Refresh the row number index, concurrent callers wait for the same column A read."""
+    global _row_numbers_refresh
+    if _row_numbers_refresh is None:
+        _row_numbers_refresh = asyncio.create_task(_refresh_row_numbers())
+        _row_numbers_refresh.add_done_callback(_clear_row_numbers_refresh)
+    
+    # Shielded, so a cancelled caller doesn't cancel the read for the others
+    return await asyncio.shield(_row_numbers_refresh)
+
+async def get_row_number(username: str, raise_errors: bool = False) -> int | None:
+    """
+    Get the row number of a username in column A.
+    Returns None if the username is not found or, unless raise_errors is set, the request fails.
+    """
+    # Row numbers come from the last fetch_list batch; only read column A for unknown usernames
+    row_number = _row_numbers.get(username)
+    if row_number is not None:
+        return row_number
+    
+    try:
+        row_numbers = await _shared_refresh_row_numbers()
+    except Exception:
+        if raise_errors:
+            raise
+        return None
+    
+    return row_numbers.get(username)
+
+async def _row_holds_username(sheets_api, row_number: int, username: str) -> bool:
+    """Check that column A of the row still holds the username, reading that one cell."""
+    values_request = sheets_api.spreadsheets().values().get(
+        spreadsheetId=config.google_sheet_id,
+        range=f"{config.google_sheet_name}!A{row_number}",
+        fields="values"
+    )
+    
+    response = await _execute_request(values_request)
+    values = response.get("values")
+    return bool(values and values[0]) and str(values[0][0]).translate(_AT_TABLE).strip() == username
+
+def _fmt_hms(td: timedelta) -> str:
+    """Format a timedelta as H:MM:SS, dropping the microseconds."""
+    h, rest = divmod(int(td.total_seconds()), 3600)
+    m, sec = divmod(rest, 60)
+    return f"{h}:{m:02d}:{sec:02d}"
+
 async def color_and_insert_data(
     username: str,
     count: int,
     sum_to_pay: int,
-    elapsed_interval: str,
+    elapsed_interval: timedelta,
 ) -> int:
     """
     Insert data and format row in a single batch operation.
-    Returns the row number if successful, None otherwise.
+    Returns the row number. Errors are raised so that a failed background write gets reported.
     """
-    try:
-        sheets_api = await get_sheets_service()
+    sheets_api = await get_sheets_service()
+    
+    # The index can be up to one sync interval old and rows may have moved since - confirm the
+    # row still holds the username before writing to it, otherwise read column A again.
+    # The fresh read replaces the index, so the stale entries stop reaching the replies too
+    row_number = _row_numbers.get(username)
+    if row_number is None or not await _row_holds_username(sheets_api, row_number, username):
+        row_number = (await _shared_refresh_row_numbers()).get(username)
+    
+    if row_number is None:
+        raise ValueError(f"Username {username} not found in the Google Sheet")
 
-        # Get column A values to find the target row
-        values_request = sheets_api.spreadsheets().values().get(
-            spreadsheetId=config.google_sheet_id, 
-            range=f"{config.google_sheet_name}!A:A"
-        )
-        
-        response = await _execute_request(values_request)
-        values = response.get("values", [])
-        
-        # Find target row number
-        row_number = None
-        for idx, row in enumerate(values, start=1):
-            if row:  # Check if row is not empty
-                cell_value = str(row[0]).strip().replace("@", "") if row[0] else ""
-                if cell_value == username:
-                    row_number = idx
-                    break
-        
-        if row_number is None:
-            return None
-
-        # Single batch request for both data update and formatting
-        batch_request_body = {
-            "requests": [
-                # Update values
-                {
-                    "updateCells": {
-                        "range": {
-                            "sheetId": 0,
-                            "startRowIndex": row_number - 1,
-                            "endRowIndex": row_number,
-                            "startColumnIndex": 1,  # Column B
-                            "endColumnIndex": 4     # Up to column D
-                        },
-                        "rows": [
-                            {
-                                "values": [
-                                    {"userEnteredValue": {"stringValue": f"# {count+1}"}},
-                                    {"userEnteredValue": {"numberValue": sum_to_pay}},
-                                    {"userEnteredValue": {"stringValue": str(elapsed_interval).split(".", 1)[0]}}
-                                ]
-                            }
-                        ],
-                        "fields": "userEnteredValue"
-                    }
-                },
-                # Apply green background formatting
-                {
-                    "repeatCell": {
-                        "range": {
-                            "sheetId": 0,
-                            "startRowIndex": row_number - 1,
-                            "endRowIndex": row_number,
-                            "startColumnIndex": 0,  # Column A
-                            "endColumnIndex": 4     # Up to column D
-                        },
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {
-                                    "red": 0.0,
-                                    "green": 1.0,
-                                    "blue": 0.0
-                                }
+    sheet_id = await get_sheet_id(sheets_api)
+
+    # Single batch request for both data update and formatting
+    batch_request_body = {
+        "requests": [
+            # Update values
+            {
+                "updateCells": {
+                    "range": {
+                        "sheetId": sheet_id,
+                        "startRowIndex": row_number - 1,
+                        "endRowIndex": row_number,
+                        "startColumnIndex": 1,  # Column B
+                        "endColumnIndex": 4     # Up to column D
+                    },
+                    "rows": [
+                        {
+                            "values": [
+                                {"userEnteredValue": {"stringValue": f"# {count+1}"}},
+                                {"userEnteredValue": {"numberValue": sum_to_pay}},
+                                {"userEnteredValue": {"stringValue": _fmt_hms(elapsed_interval)}}
+                            ]
+                        }
+                    ],
+                    "fields": "userEnteredValue"
+                }
+            },
+            # Apply green background formatting
+            {
+                "repeatCell": {
+                    "range": {
+                        "sheetId": sheet_id,
+                        "startRowIndex": row_number - 1,
+                        "endRowIndex": row_number,
+                        "startColumnIndex": 0,  # Column A
+                        "endColumnIndex": 4     # Up to column D
+                    },
+                    "cell": {
+                        "userEnteredFormat": {
+                            "backgroundColor": {
+                                "red": 0.0,
+                                "green": 1.0,
+                                "blue": 0.0
                             }
-                        },
-                        "fields": "userEnteredFormat.backgroundColor"
-                    }
+                        }
+                    },
+                    "fields": "userEnteredFormat.backgroundColor"
                 }
-            ]
-        }
+            }
+        ],
+        # Nothing from the reply is used - keep it a stub
+        "includeSpreadsheetInResponse": False,
+        "responseIncludeGridData": False
+    }
 
-        batch_update_request = sheets_api.spreadsheets().batchUpdate(
-            spreadsheetId=config.google_sheet_id,
-            body=batch_request_body
-        )
+    batch_update_request = sheets_api.spreadsheets().batchUpdate(
+        spreadsheetId=config.google_sheet_id,
+        body=batch_request_body,
+        fields="spreadsheetId"
+    )
 
-        await _execute_request(batch_update_request)
-        return row_number
-        
-    except Exception:
-        return None
\ No newline at end of file
+    await _execute_request(batch_update_request)
+    return row_number
@@ -1,8 +1,69 @@
 import asyncio
+import random
 import aiohttp
+import orjson
 from config import telegram_alerts_chats, telegram_alerts_token
 
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Shared session, so alerts reuse keep-alive connections to api.telegram.org
+_session: aiohttp.ClientSession | None = None
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75, ttl_dns_cache=300)
+        )
+    return _session
+
+
+async def close_session():
+    """Close the shared session, call on shutdown"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _send_one(session, url, chat, message, max_retries):
+    # Encoded once, every retry sends the same bytes
+    body = orjson.dumps({
+        "chat_id": chat,
+        "text": message,
+        "parse_mode": "HTML"
+    })
+
+    for i in range(max_retries + 1):
+        delay = None
+        try:
+            async with session.post(url, data=body, headers=_JSON_HEADERS) as response:
+                if response.status == 200:
+                    return
+                if response.status == 429:
+                    # Flood control - Telegram says how long to wait in the error body
+                    error = orjson.loads(await response.read())
+                    parameters = error.get("parameters") if isinstance(error, dict) else None
+                    retry_after = parameters.get("retry_after") if isinstance(parameters, dict) else None
+                    # Anything unexpected in the body falls back to the backoff below
+                    if isinstance(retry_after, (int, float)):
+                        delay = retry_after
+                elif response.status < 500:
+                    # Bad request, blocked bot etc. - retrying won't help
+                    raise Exception(f"send_telegram_message: Message sending to {chat} failed with {response.status}: {await response.text()}")
+                # 5xx falls through to the backoff below
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError):
+            pass
+        
+        if i < max_retries:
+            # Honor retry_after, otherwise capped exponential backoff with full jitter
+            await asyncio.sleep(delay if delay is not None else random.uniform(0, min(30.0, 0.5 * 2 ** i)))
+
+    raise Exception(f"send_telegram_message: Max retries reached. Message sending to {chat} failed.")
+
+
 async def send_telegram_message(
     message,
     chat_id=telegram_alerts_chats,
@@ -12,21 +73,13 @@ async def send_telegram_message(
     url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
     chat_ids = chat_id if isinstance(chat_id, list) else [chat_id]
 
-    async with aiohttp.ClientSession() as session:
-        for chat in chat_ids:
-            payload = {
-                "chat_id": chat,
-                "text": message,
-                "parse_mode": "HTML"
-            }
-
-            for i in range(max_retries + 1):
-                try:
-                    async with session.post(url, json=payload) as response:
-                        if response.status == 200:
-                            return
-                        response.raise_for_status()
-                except Exception:
-                    await asyncio.sleep(1.5 ** i)
-            else:
-                raise Exception("send_telegram_message: Max retries reached. Message sending failed.")
+    # Send to all chats at once, a slow or failing chat doesn't hold up the others
+    session = await _get_session()
+    results = await asyncio.gather(
+        *(_send_one(session, url, chat, message, max_retries) for chat in chat_ids),
+        return_exceptions=True
+    )
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise Exception(f"send_telegram_message: {len(errors)} of {len(chat_ids)} chats failed: {errors}")